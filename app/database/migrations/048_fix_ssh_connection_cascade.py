@@ -5,88 +5,274 @@ foreign key in ssh_connections table, so connections are preserved when
 an SSH key is deleted.
 
 The migration is fully idempotent:
-- Skips immediately if the CASCADE is already gone (subsequent startups).
-- Builds the new table DDL from PRAGMA table_info so it is immune to
-  columns added by later migrations (e.g. use_sftp_mode, ssh_path_prefix).
+- Returns immediately once recorded in schema_migrations (subsequent startups).
+- Skips the rebuild if the CASCADE is already gone.
+
+The fix is a targeted edit of the CREATE TABLE text stored in sqlite_master,
+so CHECK constraints, collations, defaults and columns added by later
+migrations (e.g. use_sftp_mode, ssh_path_prefix) are preserved as written.
+Changing an FK action does not alter the on-disk record format, so the edited
+text is written back in place (see "Making Other Kinds Of Table Schema
+Changes" in the SQLite ALTER TABLE docs).  Builds that refuse writes to
+sqlite_master (SQLITE_DBCONFIG_DEFENSIVE) get a full table rebuild from the
+same edited text instead.
 """
 
+import re
+
+import structlog
 from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app.database.migrations._schema_migrations import is_applied, mark_applied
+
+logger = structlog.get_logger()
+
+VERSION = 48
+
+# Connection-level PRAGMAs relaxed only while the fallback rebuild copies
+# rows, and restored afterwards.  The in-place edit writes a single
+# sqlite_master row, so it keeps the connection's own durability settings.
+# journal_mode is deliberately left alone: it is persisted in the database
+# file, and switching into or out of WAL forces a checkpoint.
+REBUILD_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": "-64000",
+}
+
+
+def _identifier(name):
+    """Regex for an SQLite identifier: bare, "double", [bracket] or `backtick` quoted"""
+    return rf'(?:"{name}"|\[{name}\]|`{name}`|\b{name}\b)'
+
+
+# ssh_key_id FK clause as written in the stored CREATE TABLE statement, in
+# either table-constraint or column-constraint form, optionally with an
+# ON UPDATE action before the ON DELETE one
+CASCADE_FK_RE = re.compile(
+    rf"(REFERENCES\s*{_identifier('ssh_keys')}"
+    rf"(?:\s*\(\s*{_identifier('id')}\s*\))?"
+    r"(?:\s+ON\s+UPDATE\s+(?:SET\s+NULL|SET\s+DEFAULT|CASCADE|RESTRICT|NO\s+ACTION))?"
+    r"\s+ON\s+DELETE\s+)CASCADE\b",
+    re.IGNORECASE,
+)
+
+# Table name in the stored CREATE TABLE statement; SQLite quotes it after an
+# ALTER TABLE ... RENAME
+TABLE_NAME_RE = re.compile(
+    rf"^(CREATE\s+TABLE\s+){_identifier('ssh_connections')}(?=\s*\()",
+    re.IGNORECASE,
+)
 
 
 def upgrade(connection):
-    """Remove CASCADE DELETE from ssh_connections.ssh_key_id foreign key"""
+    """Remove CASCADE DELETE from ssh_connections.ssh_key_id foreign key
+
+    Expects the schema_migrations table bootstrapped by run_migrations().
+    """
+
+    if is_applied(connection, VERSION):
+        return
 
     # ── Idempotency guard ────────────────────────────────────────────────────
     # PRAGMA foreign_key_list returns rows:
     #   (id, seq, table, from, to, on_update, on_delete, match)
-    fk_rows = connection.execute(
-        text("PRAGMA foreign_key_list(ssh_connections)")
-    ).fetchall()
-
-    has_cascade = any(row[6] == "CASCADE" for row in fk_rows)
+    has_cascade = any(
+        row[6] == "CASCADE"
+        for row in connection.execute(text("PRAGMA foreign_key_list(ssh_connections)"))
+    )
 
     if not has_cascade:
-        print("✓ ssh_connections FK already uses SET NULL — skipping migration 048")
+        logger.info("✓ ssh_connections FK already uses SET NULL — skipping migration 048")
+        mark_applied(connection, VERSION)
         return
 
-    print("⚠️  Fixing ssh_connections foreign key constraint...")
+    logger.warning("⚠️  Fixing ssh_connections foreign key constraint...")
+
+    # ── Single explicit transaction ──────────────────────────────────────────
+    # End any implicit transaction already open on the connection first: the
+    # PRAGMAs below cannot change inside one, and BEGIN is issued explicitly
+    # because pysqlite does not start a transaction before DDL.  Without it
+    # every statement below would autocommit (and fsync) on its own and a
+    # failure part-way would leave a half-migrated table behind.  Errors
+    # propagate and roll the whole migration back.
+    connection.commit()
+
+    # ── Disable FK enforcement ───────────────────────────────────────────────
+    # As in step 1 of SQLite's 12-step table rebuild: the app engine enables
+    # foreign_keys, and DROP TABLE ssh_connections would otherwise fail while
+    # repositories rows still reference a connection.  Integrity is
+    # re-verified with foreign_key_check before commit instead.  foreign_keys
+    # cannot change inside a transaction, so it is switched before BEGIN.
+    foreign_keys = connection.execute(text("PRAGMA foreign_keys")).scalar()
+    connection.execute(text("PRAGMA foreign_keys = OFF"))
 
+    # The PRAGMAs autobegan a SQLAlchemy transaction (no BEGIN reached SQLite)
+    connection.commit()
+
+    # Filled in only if the fallback rebuild relaxes REBUILD_PRAGMAS
+    saved_pragmas = {}
     try:
-        # ── Build new table DDL from the live schema ─────────────────────────
-        # PRAGMA table_info rows: (cid, name, type, notnull, dflt_value, pk)
-        col_rows = connection.execute(
-            text("PRAGMA table_info(ssh_connections)")
-        ).fetchall()
-
-        col_defs = []
-        for _cid, name, type_, notnull, dflt_value, pk in col_rows:
-            if pk:
-                col_defs.append(f"    {name} {type_} PRIMARY KEY")
-            else:
-                parts = [f"    {name}", type_]
-                if notnull:
-                    parts.append("NOT NULL")
-                if dflt_value is not None:
-                    parts.append(f"DEFAULT {dflt_value}")
-                col_defs.append(" ".join(parts))
-
-        # Append the corrected FK (SET NULL instead of CASCADE)
-        col_defs.append(
-            "    FOREIGN KEY (ssh_key_id) REFERENCES ssh_keys(id) ON DELETE SET NULL"
+        with connection.begin():
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+            # Earlier releases ran this migration in autocommit and swallowed
+            # errors, so deployed databases can still hold a stale, partially
+            # copied ssh_connections_new from a failed run
+            connection.execute(text("DROP TABLE IF EXISTS ssh_connections_new"))
+
+            table_sql = connection.execute(text(
+                "SELECT sql FROM sqlite_master"
+                " WHERE type = 'table' AND name = 'ssh_connections'"
+            )).scalar()
+            new_sql, matches = CASCADE_FK_RE.subn(r"\1SET NULL", table_sql)
+
+            if not matches:
+                raise RuntimeError(
+                    "Could not locate the ssh_key_id ON DELETE CASCADE clause"
+                    " in the ssh_connections table definition"
+                )
+
+            # Changing an ON DELETE action cannot orphan rows, so only an
+            # increase over the rows already orphaned means the change broke
+            # something; both paths are checked the same way
+            violations_before = _count_fk_violations(connection)
+
+            if not _patch_schema_in_place(connection, new_sql):
+                saved_pragmas = _relax_pragmas(connection)
+                _rebuild_table(connection, new_sql)
+
+            violations_after = _count_fk_violations(connection)
+            if violations_after > violations_before:
+                raise RuntimeError(
+                    f"foreign_key_check reported {violations_after} violation(s)"
+                    f" after the change, {violations_before} before"
+                )
+            if violations_before:
+                logger.warning(
+                    "Database has pre-existing foreign key violations",
+                    count=violations_before,
+                )
+            mark_applied(connection, VERSION)
+    except Exception:
+        # The transaction has rolled back: ssh_connections is untouched and no
+        # ssh_connections_new is left behind for the next startup to clean up
+        logger.exception(
+            "✗ Migration 048 failed - connections may still be deleted when keys are removed"
         )
+        raise
+    finally:
+        # Restored once the transaction has ended, where they can change
+        for name, value in saved_pragmas.items():
+            connection.execute(text(f"PRAGMA {name} = {value}"))
+        connection.execute(text(f"PRAGMA foreign_keys = {foreign_keys}"))
 
-        new_ddl = "CREATE TABLE ssh_connections_new (\n" + ",\n".join(col_defs) + "\n)"
+    logger.info("✓ SSH connection foreign key constraint fixed")
+    logger.info("✓ Connections will now be preserved when SSH keys are deleted")
 
-        # ── Guard against stale temp table from a previous interrupted run ───
-        connection.execute(text("DROP TABLE IF EXISTS ssh_connections_new"))
-        connection.execute(text(new_ddl))
 
-        # ── Copy using explicit column names (avoids SELECT * count mismatch) ─
-        col_names = ", ".join(row[1] for row in col_rows)
-        connection.execute(text(
-            f"INSERT INTO ssh_connections_new ({col_names})"
-            f" SELECT {col_names} FROM ssh_connections"
-        ))
+def _count_fk_violations(connection):
+    """Return the number of rows PRAGMA foreign_key_check reports"""
+    return len(connection.execute(text("PRAGMA foreign_key_check")).fetchall())
+
+
+def _patch_schema_in_place(connection, new_sql):
+    """Rewrite the stored CREATE TABLE statement without touching any rows
+
+    Returns False, leaving the schema untouched, if SQLite refuses writes to
+    sqlite_master (SQLITE_DBCONFIG_DEFENSIVE).
+    """
+    schema_version = connection.execute(text("PRAGMA schema_version")).scalar()
+
+    connection.execute(text("PRAGMA writable_schema = ON"))
+    try:
+        try:
+            connection.execute(
+                text(
+                    "UPDATE sqlite_master SET sql = :sql"
+                    " WHERE type = 'table' AND name = 'ssh_connections'"
+                ),
+                {"sql": new_sql},
+            )
+        except OperationalError:
+            return False
+        # Bumping schema_version makes every connection reload the schema
+        connection.execute(text(f"PRAGMA schema_version = {schema_version + 1}"))
+    finally:
+        connection.execute(text("PRAGMA writable_schema = OFF"))
+
+    integrity = connection.execute(text("PRAGMA integrity_check")).scalar()
+    if integrity != "ok":
+        raise RuntimeError(f"integrity_check failed after schema edit: {integrity}")
+
+    return True
 
-        # ── Swap tables ───────────────────────────────────────────────────────
-        connection.execute(text("DROP TABLE ssh_connections"))
-        connection.execute(text("ALTER TABLE ssh_connections_new RENAME TO ssh_connections"))
 
-        # ── Recreate index ────────────────────────────────────────────────────
-        connection.execute(text("""
-            CREATE INDEX IF NOT EXISTS ix_ssh_connections_ssh_key_id
-            ON ssh_connections(ssh_key_id)
-        """))
+def _relax_pragmas(connection):
+    """Apply REBUILD_PRAGMAS and return the values they replaced
 
-        print("✓ SSH connection foreign key constraint fixed")
-        print("✓ Connections will now be preserved when SSH keys are deleted")
+    synchronous and temp_store cannot change inside a transaction, so the
+    open one is committed first.  It holds at most the DROP of a stale
+    ssh_connections_new, and _rebuild_table() re-opens it with BEGIN
+    IMMEDIATE anyway.
+    """
+    connection.connection.commit()
+
+    saved_pragmas = {
+        name: connection.execute(text(f"PRAGMA {name}")).scalar()
+        for name in REBUILD_PRAGMAS
+    }
+    for name, value in REBUILD_PRAGMAS.items():
+        connection.execute(text(f"PRAGMA {name} = {value}"))
+    return saved_pragmas
+
+
+def _rebuild_table(connection, new_sql):
+    """Recreate ssh_connections from the edited DDL and copy all rows"""
+    new_ddl = TABLE_NAME_RE.sub(r"\1ssh_connections_new", new_sql, count=1)
+
+    # Copy using explicit column names (avoids SELECT * count mismatch).
+    # PRAGMA table_info rows: (cid, name, type, notnull, dflt_value, pk)
+    col_names = ", ".join(
+        row[1] for row in connection.execute(text("PRAGMA table_info(ssh_connections)"))
+    )
+
+    # Nothing to copy on a fresh install; skip the scan and the page writes
+    has_rows = connection.execute(
+        text("SELECT 1 FROM ssh_connections LIMIT 1")
+    ).scalar() is not None
+
+    # DROP TABLE discards every index on the old table.  Capture their DDL so
+    # all of them are replayed after the swap, building each index once from
+    # the copied rows.  Automatic indexes (sql IS NULL) come back with the
+    # UNIQUE/PRIMARY KEY constraints in the table DDL itself.
+    index_ddl = connection.execute(text(
+        "SELECT sql FROM sqlite_master"
+        " WHERE type = 'index' AND tbl_name = 'ssh_connections' AND sql IS NOT NULL"
+    )).scalars().all()
+
+    # ── Create, copy, swap and reindex in one script ─────────────────────────
+    # executescript() submits every statement in a single call instead of one
+    # driver round-trip each.  pysqlite COMMITs the open transaction before
+    # running a script (at most a stale ssh_connections_new was dropped in
+    # it), so the script re-opens it with BEGIN IMMEDIATE and leaves it open:
+    # a failing statement is still rolled back with the rest of the migration.
+    statements = ["BEGIN IMMEDIATE", new_ddl]
+    if has_rows:
+        statements.append(
+            f"INSERT INTO ssh_connections_new ({col_names})"
+            f" SELECT {col_names} FROM ssh_connections"
+        )
 
-    except Exception as e:
-        print(f"✗ Error fixing foreign key constraint: {e}")
-        print("  Note: If this fails, connections may still be deleted when keys are removed")
-        # Don't raise - allow migration to continue
+    statements += [
+        "DROP TABLE ssh_connections",
+        "ALTER TABLE ssh_connections_new RENAME TO ssh_connections",
+        *index_ddl,
+    ]
+    connection.connection.executescript(";\n".join(statements))
 
 
 def downgrade(connection):
     """Restore CASCADE DELETE behavior (not recommended)"""
-    print("✓ Downgrade skipped - keeping SET NULL behavior for safety")
+    logger.info("✓ Downgrade skipped - keeping SET NULL behavior for safety")
@@ -6,6 +6,7 @@ import structlog
 from pathlib import Path
 from sqlalchemy import text
 from app.database.database import engine
+from app.database.migrations._schema_migrations import ensure_table
 
 logger = structlog.get_logger()
 
@@ -24,6 +25,10 @@ def run_migrations():
     logger.info(f"Found {len(migration_files)} migration file(s)")
 
     with engine.connect() as connection:
+        # Bootstrap the table migrations use to record themselves as applied
+        ensure_table(connection)
+        connection.commit()
+
         for migration_file in migration_files:
             migration_name = migration_file.stem
             module_name = f"app.database.migrations.{migration_name}"
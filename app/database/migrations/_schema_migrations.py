@@ -0,0 +1,34 @@
+"""
+Persistent record of applied migrations
+
+The runner executes every migration file on every startup. Migrations that
+record themselves here can return before doing any schema introspection on
+subsequent startups.
+"""
+from sqlalchemy import text
+
+
+def ensure_table(connection):
+    """Create the schema_migrations table if it does not exist yet"""
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+
+def is_applied(connection, version: int) -> bool:
+    """Return True if the given migration version has been recorded"""
+    return connection.execute(
+        text("SELECT 1 FROM schema_migrations WHERE version = :version"),
+        {"version": version},
+    ).scalar() is not None
+
+
+def mark_applied(connection, version: int):
+    """Record the given migration version as applied"""
+    connection.execute(
+        text("INSERT OR IGNORE INTO schema_migrations (version) VALUES (:version)"),
+        {"version": version},
+    )
@@ -2,38 +2,97 @@
 Database fixtures for testing
 """
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.pool import StaticPool
 
 from app.database.database import Base
 from app.database.models import User, Repository
 
-@pytest.fixture(scope="function")
+@pytest.fixture(scope="session")
 def db_engine():
-    """Create an in-memory SQLite database engine for testing"""
+    """Create an in-memory SQLite database engine shared by the test session
+
+    The schema is created once; db_session isolates each test in a
+    transaction that is rolled back afterwards.
+    """
     engine = create_engine(
         "sqlite:///:memory:",
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
+
+    # pysqlite's implicit transaction handling breaks SAVEPOINT; disable it
+    # and let SQLAlchemy emit BEGIN itself
+    @event.listens_for(engine, "connect")
+    def disable_pysqlite_begin(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def emit_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
     Base.metadata.create_all(bind=engine)
     yield engine
     Base.metadata.drop_all(bind=engine)
     engine.dispose()
 
 
+@pytest.fixture(scope="session")
+def sqlite_engine_factory():
+    """Factory returning a shared in-memory SQLite engine with a fresh schema
+
+    Call it with one or more DDL statements. Every call drops all existing
+    tables and views first, so tests that need hand-written (e.g.
+    pre-migration) schemas share a single engine instead of building one each.
+    """
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+
+    def make_engine(*ddl_statements):
+        with engine.connect() as conn:
+            # A previous test may have enabled enforcement on the shared connection
+            conn.execute(text("PRAGMA foreign_keys = OFF"))
+            objects = conn.execute(text(
+                "SELECT type, name FROM sqlite_master"
+                " WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'"
+            )).fetchall()
+            for type_, name in objects:
+                conn.execute(text(f'DROP {type_.upper()} IF EXISTS "{name}"'))
+            for ddl in ddl_statements:
+                conn.execute(text(ddl))
+            conn.commit()
+        return engine
+
+    yield make_engine
+    engine.dispose()
+
+
 @pytest.fixture(scope="function")
 def db_session(db_engine):
-    """Create a new database session for a test with rollback"""
-    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
-    session = TestingSessionLocal()
+    """Create a new database session for a test with rollback
+
+    The session joins an outer transaction on its own connection; commits
+    inside the test only release a SAVEPOINT, and the outer transaction is
+    rolled back afterwards so no data leaks into the next test.
+    """
+    connection = db_engine.connect()
+    transaction = connection.begin()
+    session = Session(
+        bind=connection,
+        autoflush=False,
+        join_transaction_mode="create_savepoint",
+    )
 
     try:
         yield session
     finally:
-        session.rollback()
         session.close()
+        transaction.rollback()
+        connection.close()
 
 @pytest.fixture(scope="function")
 def db_session_commit(db_engine):
@@ -45,8 +104,12 @@ def db_session_commit(db_engine):
         yield session
     finally:
         # We don't rollback here because we want the background task to see the changes
-        # But we do close the session
+        # But we do close the session, and clear the committed rows so they
+        # don't leak into later tests sharing the engine
         session.close()
+        with db_engine.begin() as conn:
+            for table in reversed(Base.metadata.sorted_tables):
+                conn.execute(table.delete())
 
 @pytest.fixture
 def sample_user(db_session: Session):
@@ -1,12 +1,19 @@
 """
 Unit tests for database CRUD operations
 """
+import importlib
+
 import pytest
+from unittest.mock import patch
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 
 from app.database.models import Repository, User
 from app.core.security import get_password_hash, verify_password
+from app.database.migrations._schema_migrations import ensure_table
+
+# Numeric module names cannot be imported with a plain import statement
+m048 = importlib.import_module("app.database.migrations.048_fix_ssh_connection_cascade")
 
 
 @pytest.mark.unit
@@ -141,33 +148,47 @@ class TestUserCRUD:
 class TestMigration048:
     """Tests for migration 048: fix ssh_connections FK cascade (issue #308)
 
-    The migration runner has no tracking — every migration runs on every
-    startup.  Migration 048 must therefore be fully idempotent and must work
-    regardless of how many columns ssh_connections currently has.
+    The migration runner executes every migration on every startup.  Migration
+    048 records itself in schema_migrations, but must still be fully idempotent
+    and must work regardless of how many columns ssh_connections currently has.
     """
 
-    def _make_engine(self, ddl: str):
-        """Return an in-memory SQLite engine with ssh_keys + ssh_connections."""
-        from sqlalchemy import create_engine
-        from sqlalchemy.pool import StaticPool
+    SSH_KEYS_DDL = "CREATE TABLE ssh_keys (id INTEGER PRIMARY KEY, name TEXT)"
 
-        engine = create_engine(
-            "sqlite:///:memory:",
-            connect_args={"check_same_thread": False},
-            poolclass=StaticPool,
-        )
+    def _make_engine(self, sqlite_engine_factory, ddl: str):
+        """Return the shared engine with ssh_keys, ssh_connections and the
+        schema_migrations table the migration runner bootstraps."""
+        engine = sqlite_engine_factory(self.SSH_KEYS_DDL, ddl)
         with engine.connect() as conn:
-            conn.execute(text("CREATE TABLE ssh_keys (id INTEGER PRIMARY KEY, name TEXT)"))
-            conn.execute(text(ddl))
+            ensure_table(conn)
             conn.commit()
         return engine
 
-    def test_fixes_cascade_to_set_null(self):
+    @staticmethod
+    def _rootpage(conn):
+        return conn.execute(text(
+            "SELECT rootpage FROM sqlite_master WHERE name = 'ssh_connections'"
+        )).scalar()
+
+    def _upgrade(self, conn, schema_writable: bool):
+        """Run upgrade on the requested path, asserting it is the one taken.
+
+        The in-place edit must leave the table's b-tree where it was; the
+        fallback is forced by making the sqlite_master write decline.
+        """
+        if schema_writable:
+            rootpage = self._rootpage(conn)
+            with patch.object(m048, "_rebuild_table") as rebuild:
+                m048.upgrade(conn)
+            rebuild.assert_not_called()
+            assert self._rootpage(conn) == rootpage
+        else:
+            with patch.object(m048, "_patch_schema_in_place", return_value=False):
+                m048.upgrade(conn)
+
+    def test_fixes_cascade_to_set_null(self, sqlite_engine_factory):
         """CASCADE FK is replaced with SET NULL after upgrade runs."""
-        import importlib
-        m048 = importlib.import_module("app.database.migrations.048_fix_ssh_connection_cascade")
-
-        engine = self._make_engine("""
+        engine = self._make_engine(sqlite_engine_factory, """
             CREATE TABLE ssh_connections (
                 id INTEGER PRIMARY KEY,
                 ssh_key_id INTEGER,
@@ -181,7 +202,7 @@ class TestMigration048:
         """)
 
         with engine.connect() as conn:
-            m048.upgrade(conn)
+            self._upgrade(conn, schema_writable=True)
             conn.commit()
             fk_rows = conn.execute(text("PRAGMA foreign_key_list(ssh_connections)")).fetchall()
 
@@ -189,12 +210,9 @@ class TestMigration048:
         assert "CASCADE" not in on_delete_actions
         assert "SET NULL" in on_delete_actions
 
-    def test_idempotent_when_already_set_null(self):
+    def test_idempotent_when_already_set_null(self, sqlite_engine_factory):
         """Running upgrade again after it already ran must not raise."""
-        import importlib
-        m048 = importlib.import_module("app.database.migrations.048_fix_ssh_connection_cascade")
-
-        engine = self._make_engine("""
+        engine = self._make_engine(sqlite_engine_factory, """
             CREATE TABLE ssh_connections (
                 id INTEGER PRIMARY KEY,
                 ssh_key_id INTEGER,
@@ -213,14 +231,11 @@ class TestMigration048:
         on_delete_actions = [row[6] for row in fk_rows]
         assert "CASCADE" not in on_delete_actions
 
-    def test_handles_extra_columns(self):
+    def test_handles_extra_columns(self, sqlite_engine_factory):
         """Upgrade works when the table has extra columns added by later migrations."""
-        import importlib
-        m048 = importlib.import_module("app.database.migrations.048_fix_ssh_connection_cascade")
-
         # Simulate the real-world case: table already has use_sftp_mode and
         # ssh_path_prefix (added by migrations 059 and 066) plus CASCADE still present.
-        engine = self._make_engine("""
+        engine = self._make_engine(sqlite_engine_factory, """
             CREATE TABLE ssh_connections (
                 id INTEGER PRIMARY KEY,
                 ssh_key_id INTEGER,
@@ -243,7 +258,6 @@ class TestMigration048:
             ))
             conn.commit()
 
-        with engine.connect() as conn:
             m048.upgrade(conn)
             conn.commit()
 
@@ -258,3 +272,257 @@ class TestMigration048:
         assert len(rows) == 1
         assert "use_sftp_mode" in col_names
         assert "ssh_path_prefix" in col_names
+
+    def test_rebuilds_when_schema_not_writable(self, sqlite_engine_factory):
+        """Falls back to a full table rebuild when sqlite_master cannot be edited."""
+        engine = self._make_engine(sqlite_engine_factory, """
+            CREATE TABLE ssh_connections (
+                id INTEGER PRIMARY KEY,
+                ssh_key_id INTEGER REFERENCES ssh_keys ON DELETE CASCADE,
+                host TEXT NOT NULL COLLATE NOCASE CHECK (host <> '')
+            )
+        """)
+
+        with engine.connect() as conn:
+            conn.execute(text("CREATE INDEX ix_ssh_connections_host ON ssh_connections (host)"))
+            # Child table referencing ssh_connections, like repositories.connection_id
+            conn.execute(text(
+                "CREATE TABLE repositories (id INTEGER PRIMARY KEY,"
+                " connection_id INTEGER REFERENCES ssh_connections(id))"
+            ))
+            conn.execute(text("INSERT INTO ssh_connections (id, host) VALUES (1, 'host1')"))
+            conn.execute(text("INSERT INTO repositories (connection_id) VALUES (1)"))
+            conn.commit()
+            # Enforce FKs as the app engine does (database.py)
+            conn.execute(text("PRAGMA foreign_keys = ON"))
+            conn.execute(text("PRAGMA synchronous = FULL"))
+
+            with patch.object(m048, "_patch_schema_in_place", return_value=False), \
+                    patch.object(m048, "_relax_pragmas", wraps=m048._relax_pragmas) as relax:
+                m048.upgrade(conn)
+            conn.commit()
+
+            foreign_keys = conn.execute(text("PRAGMA foreign_keys")).scalar()
+            synchronous = conn.execute(text("PRAGMA synchronous")).scalar()
+            violations = conn.execute(text("PRAGMA foreign_key_check")).fetchall()
+            child_rows = conn.execute(text("SELECT connection_id FROM repositories")).fetchall()
+
+            fk_rows = conn.execute(text("PRAGMA foreign_key_list(ssh_connections)")).fetchall()
+            rows = conn.execute(text("SELECT host FROM ssh_connections")).fetchall()
+            table_sql = conn.execute(text(
+                "SELECT sql FROM sqlite_master WHERE name = 'ssh_connections'"
+            )).scalar()
+            index_names = [row[1] for row in conn.execute(text("PRAGMA index_list(ssh_connections)"))]
+
+        on_delete_actions = [row[6] for row in fk_rows]
+        assert on_delete_actions == ["SET NULL"]
+        assert rows == [("host1",)]
+        # Column constraints are carried over verbatim from the original DDL
+        assert "COLLATE NOCASE CHECK (host <> '')" in table_sql
+        # Every index on the original table is recreated
+        assert index_names == ["ix_ssh_connections_host"]
+        # Child rows survive the parent swap and enforcement is restored
+        assert child_rows == [(1,)]
+        assert violations == []
+        assert foreign_keys == 1
+        # Durability is relaxed for the row copy only, then restored (2 = FULL)
+        relax.assert_called_once()
+        assert synchronous == 2
+
+    def test_in_place_fix_keeps_pragmas(self, sqlite_engine_factory):
+        """The in-place edit runs with the connection's own durability settings."""
+        engine = self._make_engine(sqlite_engine_factory, """
+            CREATE TABLE ssh_connections (
+                id INTEGER PRIMARY KEY,
+                ssh_key_id INTEGER,
+                FOREIGN KEY (ssh_key_id) REFERENCES ssh_keys(id) ON DELETE CASCADE
+            )
+        """)
+
+        with engine.connect() as conn:
+            conn.execute(text("PRAGMA synchronous = FULL"))
+
+            with patch.object(m048, "_relax_pragmas") as relax:
+                m048.upgrade(conn)
+            conn.commit()
+
+            synchronous = conn.execute(text("PRAGMA synchronous")).scalar()
+
+        relax.assert_not_called()
+        assert synchronous == 2
+
+    @pytest.mark.parametrize("schema_writable", [True, False])
+    def test_drops_stale_temp_table(self, sqlite_engine_factory, schema_writable):
+        """A ssh_connections_new left by a failed pre-transactional run is removed."""
+        engine = self._make_engine(sqlite_engine_factory, """
+            CREATE TABLE ssh_connections (
+                id INTEGER PRIMARY KEY,
+                ssh_key_id INTEGER,
+                host TEXT NOT NULL,
+                FOREIGN KEY (ssh_key_id) REFERENCES ssh_keys(id) ON DELETE CASCADE
+            )
+        """)
+
+        with engine.connect() as conn:
+            conn.execute(text("INSERT INTO ssh_connections (host) VALUES ('host1')"))
+            conn.execute(text(
+                "CREATE TABLE ssh_connections_new AS SELECT * FROM ssh_connections"
+            ))
+            conn.commit()
+
+            self._upgrade(conn, schema_writable)
+            conn.commit()
+
+            fk_rows = conn.execute(text("PRAGMA foreign_key_list(ssh_connections)")).fetchall()
+            tables = conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE name = 'ssh_connections_new'"
+            )).fetchall()
+
+        assert [row[6] for row in fk_rows] == ["SET NULL"]
+        assert tables == []
+
+    def test_runs_with_caller_transaction_open(self, sqlite_engine_factory):
+        """Upgrade works when the caller left an implicit transaction open."""
+        engine = self._make_engine(sqlite_engine_factory, """
+            CREATE TABLE ssh_connections (
+                id INTEGER PRIMARY KEY,
+                ssh_key_id INTEGER,
+                host TEXT NOT NULL,
+                FOREIGN KEY (ssh_key_id) REFERENCES ssh_keys(id) ON DELETE CASCADE
+            )
+        """)
+
+        with engine.connect() as conn:
+            # Uncommitted DML: pysqlite has an open transaction at this point
+            conn.execute(text("INSERT INTO ssh_connections (host) VALUES ('host1')"))
+
+            m048.upgrade(conn)
+            conn.commit()
+
+            fk_rows = conn.execute(text("PRAGMA foreign_key_list(ssh_connections)")).fetchall()
+            rows = conn.execute(text("SELECT host FROM ssh_connections")).fetchall()
+
+        assert [row[6] for row in fk_rows] == ["SET NULL"]
+        assert rows == [("host1",)]
+
+    def test_preexisting_orphans_do_not_block_fix(self, sqlite_engine_factory):
+        """Rows already orphaned before the migration do not make it fail."""
+        engine = self._make_engine(sqlite_engine_factory, """
+            CREATE TABLE ssh_connections (
+                id INTEGER PRIMARY KEY,
+                ssh_key_id INTEGER,
+                host TEXT NOT NULL,
+                FOREIGN KEY (ssh_key_id) REFERENCES ssh_keys(id) ON DELETE CASCADE
+            )
+        """)
+
+        with engine.connect() as conn:
+            # ssh_key_id 99 does not exist in ssh_keys
+            conn.execute(text("INSERT INTO ssh_connections VALUES (2, 99, 'orphan')"))
+            conn.commit()
+
+            m048.upgrade(conn)
+            conn.commit()
+
+            fk_rows = conn.execute(text("PRAGMA foreign_key_list(ssh_connections)")).fetchall()
+            rows = conn.execute(text("SELECT * FROM ssh_connections")).fetchall()
+
+        assert [row[6] for row in fk_rows] == ["SET NULL"]
+        assert rows == [(2, 99, "orphan")]
+
+    @pytest.mark.parametrize("schema_writable", [True, False])
+    @pytest.mark.parametrize("ddl", [
+        # Table constraint, as written by earlier migrations
+        "CREATE TABLE ssh_connections (id INTEGER PRIMARY KEY, ssh_key_id INTEGER,"
+        " FOREIGN KEY(ssh_key_id) REFERENCES ssh_keys (id) ON DELETE CASCADE)",
+        # Column constraint without a referenced column
+        "CREATE TABLE ssh_connections (id INTEGER PRIMARY KEY,"
+        " ssh_key_id INTEGER REFERENCES ssh_keys ON DELETE CASCADE)",
+        # ON UPDATE action before ON DELETE
+        "CREATE TABLE ssh_connections (id INTEGER PRIMARY KEY, ssh_key_id INTEGER,"
+        " FOREIGN KEY (ssh_key_id) REFERENCES ssh_keys(id) ON UPDATE NO ACTION ON DELETE CASCADE)",
+        # Double-quoted identifiers
+        'CREATE TABLE "ssh_connections" (id INTEGER PRIMARY KEY, ssh_key_id INTEGER,'
+        ' FOREIGN KEY ("ssh_key_id") REFERENCES "ssh_keys" ("id") ON DELETE CASCADE)',
+        # Bracket-quoted identifiers
+        "CREATE TABLE [ssh_connections] (id INTEGER PRIMARY KEY, ssh_key_id INTEGER,"
+        " FOREIGN KEY ([ssh_key_id]) REFERENCES [ssh_keys] ([id]) ON DELETE CASCADE)",
+        # Backtick-quoted identifiers, lower case keywords
+        "CREATE TABLE `ssh_connections` (id INTEGER PRIMARY KEY, ssh_key_id INTEGER,"
+        " foreign key (`ssh_key_id`) references `ssh_keys`(`id`) on update cascade on delete cascade)",
+    ])
+    def test_supported_fk_spellings(self, sqlite_engine_factory, ddl, schema_writable):
+        """Every supported spelling of the ssh_key_id FK clause is fixed on both paths."""
+        engine = self._make_engine(sqlite_engine_factory, ddl)
+
+        with engine.connect() as conn:
+            self._upgrade(conn, schema_writable)
+            conn.commit()
+
+            fk_rows = conn.execute(text("PRAGMA foreign_key_list(ssh_connections)")).fetchall()
+
+        assert [row[6] for row in fk_rows] == ["SET NULL"]
+
+    def test_failed_rebuild_rolls_back(self, sqlite_engine_factory):
+        """A failure part-way through the rebuild leaves the original table intact."""
+        engine = self._make_engine(sqlite_engine_factory, """
+            CREATE TABLE ssh_connections (
+                id INTEGER PRIMARY KEY,
+                ssh_key_id INTEGER REFERENCES ssh_keys ON DELETE CASCADE,
+                host TEXT NOT NULL
+            )
+        """)
+
+        with engine.connect() as conn:
+            # The view makes the final RENAME fail after the copy has run
+            conn.execute(text("CREATE VIEW ssh_hosts AS SELECT host FROM ssh_connections"))
+            conn.execute(text("INSERT INTO ssh_connections (host) VALUES ('host1')"))
+            conn.commit()
+
+            with patch.object(m048, "_patch_schema_in_place", return_value=False):
+                with pytest.raises(Exception):
+                    m048.upgrade(conn)
+            conn.rollback()
+
+            fk_rows = conn.execute(text("PRAGMA foreign_key_list(ssh_connections)")).fetchall()
+            rows = conn.execute(text("SELECT host FROM ssh_connections")).fetchall()
+            tables = conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE name = 'ssh_connections_new'"
+            )).fetchall()
+            versions = conn.execute(text("SELECT version FROM schema_migrations")).fetchall()
+
+        assert [row[6] for row in fk_rows] == ["CASCADE"]
+        assert rows == [("host1",)]
+        assert tables == []
+        assert versions == []
+
+    def test_records_version_and_skips_on_rerun(self, sqlite_engine_factory):
+        """Upgrade records version 48 and later runs leave ssh_connections alone."""
+        engine = self._make_engine(sqlite_engine_factory, """
+            CREATE TABLE ssh_connections (
+                id INTEGER PRIMARY KEY,
+                ssh_key_id INTEGER,
+                host TEXT NOT NULL,
+                FOREIGN KEY (ssh_key_id) REFERENCES ssh_keys(id) ON DELETE CASCADE
+            )
+        """)
+
+        with engine.connect() as conn:
+            m048.upgrade(conn)
+            conn.commit()
+            versions = conn.execute(text("SELECT version FROM schema_migrations")).scalars().all()
+
+            # Put the CASCADE back: a recorded migration must not fix it again
+            conn.execute(text("DROP TABLE ssh_connections"))
+            conn.execute(text(
+                "CREATE TABLE ssh_connections (id INTEGER PRIMARY KEY, ssh_key_id INTEGER,"
+                " FOREIGN KEY (ssh_key_id) REFERENCES ssh_keys(id) ON DELETE CASCADE)"
+            ))
+            conn.commit()
+            m048.upgrade(conn)
+            conn.commit()
+
+            fk_rows = conn.execute(text("PRAGMA foreign_key_list(ssh_connections)")).fetchall()
+
+        assert versions == [48]
+        assert [row[6] for row in fk_rows] == ["CASCADE"]